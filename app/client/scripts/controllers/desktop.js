@@ -14,6 +14,7 @@ angular.module('fbCal')
                                        list, server) {
 
     var eventData = [];
+    var eventWindow = null;
 
     /**
      * Calls the appropriate function in List.js to get appropriate style for
@@ -71,8 +72,9 @@ angular.module('fbCal')
        * }
        */
       eventData = response.fb_event_data;
+      eventWindow = response.window || null;
       if ($scope.settings.view === "Month") {
-        desktopCalendar.setup(eventData);
+        desktopCalendar.setup(eventData, eventWindow);
       } else {
         $scope.eventList = list.setup($scope.settings.borderWidth, eventData);
       }
@@ -83,13 +85,22 @@ angular.module('fbCal')
      * allows the widget to implement these changes immediately.
      *
      * View changes in the settings panel results in the appropriate setup
-     * funtion being called.
+     * funtion being called. If only the events of a window of time were
+     * loaded for Month view, all the events are loaded for List view.
      */
     $wix.addEventListener($wix.Events.SETTINGS_UPDATED, function(message) {
       if (message.settings.view === 'Month' && $scope.settings.view === 'List') {
-        desktopCalendar.setup(eventData);
+        desktopCalendar.setup(eventData, eventWindow);
       } else if (message.settings.view === 'List' && $scope.settings.view === 'Month') {
-        $scope.eventList = list.setup(message.settings.borderWidth, eventData);
+        if (eventWindow) {
+          server.getEventsWindow(null).then(function(events) {
+            eventData = events;
+            eventWindow = null;
+            $scope.eventList = list.setup(message.settings.borderWidth, eventData);
+          });
+        } else {
+          $scope.eventList = list.setup(message.settings.borderWidth, eventData);
+        }
       }
       $scope.settings = message.settings;
       $scope.$apply();
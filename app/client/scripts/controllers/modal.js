@@ -51,6 +51,12 @@ angular.module('fbCal')
      * @type {Boolean}
      */
     var notGettingMoreFeed = true;
+    /**
+     * How many more pages of comments the server adds to the first statuses
+     * of the feed, so that showing more replies does not need another request.
+     * @type {Number}
+     */
+    var commentPages = 1;
 
     /**
      * The current error being shown to the user
@@ -784,7 +790,8 @@ angular.module('fbCal')
             .then(function(response) {
               server.getModalEvent($scope.eventId, "guests")
                 .then(function(response) {
-                  server.getModalEvent($scope.eventId, "feed")
+                  server.getModalEvent($scope.eventId, "feed",
+                                       commentPages)
                     .then(function(response) {
                       feedObject = response;
                       processFeed();
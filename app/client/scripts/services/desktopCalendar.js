@@ -7,7 +7,8 @@
  * @author Jeffrey Chan
  */
 
-angular.module('fbCal').factory('desktopCalendar', function ($wix, $rootScope) {
+angular.module('fbCal').factory('desktopCalendar', function ($wix, $rootScope,
+                                                             server) {
 
   /**
    * This function initializes the calendar in the widget with the provided 
@@ -28,14 +29,47 @@ angular.module('fbCal').factory('desktopCalendar', function ($wix, $rootScope) {
    *      DOM element what the month the Calendar is on so it can display it
    *      to the user.
    * 
-   * @param  {Array} eventData The events to be placed on the calendar
+   * If the events only cover a window of time (the server only sends the
+   * events of the current month in Month view), the events of other months
+   * are loaded from the server when the user navigates to them. The calendar
+   * is then redrawn with these events.
+   * 
+   * @param  {Array} eventData    The events to be placed on the calendar
+   * @param  {Object} eventWindow The window of time covered by the events (or
+   *                              null if they are all the events)
    */
-  var setup = function(eventData) {
+  var setup = function(eventData, eventWindow) {
     var processedData = processEventData(eventData);
-    var calendar = $("#calendar").calendar(
+    var loadedWindows = eventWindow ? [eventWindow] : null;
+    var calendar;
+
+    /**
+     * Gives the calendar the events loaded so far. If the month being shown
+     * is not loaded yet, its events are requested from the server.
+     * 
+     * @param  {Date} start Start of the time shown by the calendar
+     * @param  {Date} end   End of the time shown by the calendar
+     * @return {Array}      The events loaded so far
+     */
+    var eventsSource = function(start, end) {
+      if (loadedWindows && !isLoaded(loadedWindows, start.getTime(), end.getTime())) {
+        var monthWindow = server.getMonthWindow(start);
+        loadedWindows.push(monthWindow);
+        server.getEventsWindow(monthWindow).then(function(events) {
+          processedData = mergeEvents(processedData, processEventData(events));
+          calendar.view();
+          $wix.setHeight($('#desktop').outerHeight());
+        }, function() {
+          loadedWindows.splice(loadedWindows.indexOf(monthWindow), 1);
+        });
+      }
+      return processedData;
+    };
+
+    calendar = $("#calendar").calendar(
         {
            tmpl_path: "client/views/tmpls/",
-           events_source: processedData,
+           events_source: eventsSource,
             // onAfterEventsLoad: function(events) {
             //   if(!events) {
             //     return;
@@ -100,6 +134,49 @@ angular.module('fbCal').factory('desktopCalendar', function ($wix, $rootScope) {
     return processedEvents;
   };
 
+  /**
+   * Whether the time from start to end is covered by one of the windows that
+   * have been loaded (or are being loaded).
+   * 
+   * @param  {Array} windows List of windows loaded
+   * @param  {Number} start  Start of the time (in milliseconds)
+   * @param  {Number} end    End of the time (in milliseconds)
+   * @return {Boolean}       Whether the time is loaded
+   */
+  var isLoaded = function(windows, start, end) {
+    for (var i = 0; i < windows.length; i++) {
+      if (windows[i].start <= start && windows[i].end >= end) {
+        return true;
+      }
+    }
+    return false;
+  };
+
+  /**
+   * Adds the newly loaded events to the events already on the calendar,
+   * leaving out the ones that are already there.
+   * 
+   * @param  {Array} events    The events already on the calendar
+   * @param  {Array} newEvents The newly loaded events
+   * @return {Array}           All the events
+   */
+  var mergeEvents = function(events, newEvents) {
+    var merged = [].concat(events);
+    for (var i = 0; i < newEvents.length; i++) {
+      var found = false;
+      for (var j = 0; j < events.length; j++) {
+        if (events[j].id === newEvents[i].id && events[j].start === newEvents[i].start) {
+          found = true;
+          break;
+        }
+      }
+      if (!found) {
+        merged.push(newEvents[i]);
+      }
+    }
+    return merged;
+  };
+
   return {
     setup: setup
   };
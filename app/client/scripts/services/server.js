@@ -23,6 +23,7 @@ angular.module('fbCal').factory('server', function ($log, $http, $wix, api,
    */
   var getSettingsWidgetURL = '/GetSettingsWidget/' + compId;
   var getSettingsSettingsURL = '/GetSettingsSettings/' + compId;
+  var getEventsWindowURL = '/GetEventsWindow/' + compId;
   var getAllEventsURL = '/GetAllEvents/' + compId;
   var getModalEventURL = '/GetModalEvent/' + compId;
   var getModalFeedURL = '/GetModalFeed/' + compId;
@@ -106,23 +107,124 @@ angular.module('fbCal').factory('server', function ($log, $http, $wix, api,
     }
   };
 
+  /**
+   * Returns the window of time shown by the calendar in Month view for the
+   * month of the given date. The window includes a week on either side since
+   * the calendar also shows the last and first days of the months around it.
+   * 
+   * @param  {Date} date Any date in the month
+   * @return {Object}    The start and end of the window (in milliseconds)
+   */
+  var getMonthWindow = function(date) {
+    var week = 7 * 24 * 60 * 60 * 1000;
+    return {start : new Date(date.getFullYear(), date.getMonth(), 1).getTime() - week,
+            end : new Date(date.getFullYear(), date.getMonth() + 1, 1).getTime() + week};
+  };
+
+  /**
+   * Returns the copy of the settings last received from the server along with
+   * its ETag, if there is one stored in this browser.
+   * 
+   * @param  {String} from Who is making the request (Widget or Settings)
+   * @return {Object}      The stored copy (etag and response) or null
+   */
+  var getStoredCopy = function(from) {
+    try {
+      var stored = $window.localStorage.getItem(getURL('get', from));
+      return stored ? JSON.parse(stored) : null;
+    } catch (e) {
+      return null;
+    }
+  };
+
+  /**
+   * Stores the settings received from the server along with their ETag so
+   * that the next page view only has to revalidate them with the server.
+   * 
+   * @param  {String} from     Who is making the request (Widget or Settings)
+   * @param  {String} etag     The ETag the server sent with the settings
+   * @param  {Object} response The parsed settings from the server
+   */
+  var storeCopy = function(from, etag, response) {
+    try {
+      if (etag) {
+        $window.localStorage.setItem(getURL('get', from),
+          JSON.stringify({etag : etag, response : response}));
+      }
+    } catch (e) {
+      $log.warn('Could not store the settings in this browser.');
+    }
+  };
+
+  /**
+   * Adds the "last_write" header the server sent back after the last save in
+   * this browser (if there is one) so that the server reads from its primary
+   * database until its read replicas have the save.
+   * 
+   * @param  {Object} headers The headers of the request
+   * @return {Object}         The same headers
+   */
+  var withLastWrite = function(headers) {
+    try {
+      var lastWrite = $window.localStorage.getItem('last_write');
+      if (lastWrite) {
+        headers.last_write = lastWrite;
+      }
+    } catch (e) {}
+    return headers;
+  };
+
+  /**
+   * Stores the "last_write" header the server sent back after a save.
+   * 
+   * @param  {Function} responseHeaders The headers of the response
+   */
+  var storeLastWrite = function(responseHeaders) {
+    try {
+      var lastWrite = responseHeaders('last_write');
+      if (lastWrite) {
+        $window.localStorage.setItem('last_write', lastWrite);
+      }
+    } catch (e) {
+      $log.warn('Could not store the last save in this browser.');
+    }
+  };
+
   /**
    * This function makes a call to the backend database to get the
    * latest user settings. It's called whenever the widget or settings panal
    * is first loaded. On errors or empty settings from the server, the default
    * settings are loaded.
+   *
+   * If a copy of the settings from a previous load is stored, the server is
+   * only asked whether it has changed (If-None-Match). A 304 reply means the
+   * stored copy is used.
+   *
+   * The widget asks for the events of the current month only. If the server
+   * returns a window with the events, only the events in that window were
+   * sent (because the widget is in Month view).
    * 
    * @param  {String} from        Who is making the request (Widget or Settings)
    * @return {Object}             A promise to return the settings
    */
   var getUserInfo = function(from) {
     var deferred = $q.defer();
+    var storedCopy = getStoredCopy(from);
+    var headers = {'X-Wix-Instance' : instance};
+    if (storedCopy) {
+      headers['If-None-Match'] = storedCopy.etag;
+    }
+    if (from === 'widget') {
+      var monthWindow = getMonthWindow(new Date());
+      headers.window_start = monthWindow.start.toString();
+      headers.window_end = monthWindow.end.toString();
+    }
     $http({
            method: 'GET',
            url: getURL('get', from),
-           headers: {'X-Wix-Instance' : instance},
+           headers: withLastWrite(headers),
            timeout: 15000
-          }).success(function (data, status) {
+          }).success(function (data, status, responseHeaders) {
             if (status === 200) {
               var response = jQuery.parseJSON(jQuery.parseJSON(data));
               if (!response.settings) {
@@ -134,14 +236,53 @@ angular.module('fbCal').factory('server', function ($log, $http, $wix, api,
               if (from === 'widget' && !response.fb_event_data) {
                 response.fb_event_data = [];
               }
+              storeCopy(from, responseHeaders('ETag'), response);
               deferred.resolve(response);
             } else {
               $log.warn('The server is returning an incorrect status.');
               deferred.reject(getDefault(from));
             }
+          }).error(function (message, status) {
+            if (status === 304 && storedCopy) {
+              deferred.resolve(storedCopy.response);
+            } else {
+              console.debug(status, message);
+              deferred.reject(getDefault(from));
+            }
+          });
+    return deferred.promise;
+  };
+
+  /**
+   * This is used by the widget in Month view to get the events taking place
+   * in a window of time. Without a window, all the events are returned.
+   * 
+   * @param  {Object} monthWindow The start and end of the window (or null)
+   * @return {Object}             Promise to return the events
+   */
+  var getEventsWindow = function(monthWindow) {
+    var headers = {'X-Wix-Instance' : instance};
+    if (monthWindow) {
+      headers.window_start = monthWindow.start.toString();
+      headers.window_end = monthWindow.end.toString();
+    }
+    var deferred = $q.defer();
+    $http({
+           method: 'GET',
+           url: getEventsWindowURL,
+           headers: withLastWrite(headers),
+           timeout: 15000
+          }).success(function (data, status) {
+            if (status === 200) {
+              var response = jQuery.parseJSON(jQuery.parseJSON(data));
+              deferred.resolve(response.fb_event_data);
+            } else {
+              $log.warn('The server is returning an incorrect status.');
+              deferred.reject();
+            }
           }).error(function (message, status) {
             console.debug(status, message);
-            deferred.reject(getDefault(from));
+            deferred.reject();
           });
     return deferred.promise;
   };
@@ -158,7 +299,7 @@ angular.module('fbCal').factory('server', function ($log, $http, $wix, api,
     $http({
            method: 'GET',
            url: getAllEventsURL,
-           headers: {'X-Wix-Instance' : instance},
+           headers: withLastWrite({'X-Wix-Instance' : instance}),
            timeout: 15000
           }).success(function (data, status) {
             if (status === 200) {
@@ -179,18 +320,24 @@ angular.module('fbCal').factory('server', function ($log, $http, $wix, api,
    * @param  {String} eventId     The event ID for the event you want data about
    * @param  {String} desiredData The desired data you want about this event
    *                              (e.g. cover photo, feed)
+   * @param  {Number} commentPages (Optional) For the feed, how many more pages
+   *                              of comments the server should add to the
+   *                              first statuses
    * @return {Object}             Promise to return the event data
    */
-  var getModalEvent = function(eventId, desiredData) {
+  var getModalEvent = function(eventId, desiredData, commentPages) {
     var modalHeader = {'X-Wix-Instance' : instance, 
                        'event_id' : eventId.toString(),
                        'desired_data' : desiredData
                       };
+    if (commentPages) {
+      modalHeader.comment_pages = commentPages.toString();
+    }
     var deferred = $q.defer();
     $http({
            method: 'GET',
            url: getModalEventURL,
-           headers: modalHeader,
+           headers: withLastWrite(modalHeader),
            timeout: 15000
           }).success(function (data, status) {
             if (status === 200) {
@@ -226,7 +373,8 @@ angular.module('fbCal').factory('server', function ($log, $http, $wix, api,
     $http({
            method: 'GET',
            url: getModalFeedURL,
-           headers: getFeedHeader(params, desiredData, eventId),
+           headers: withLastWrite(getFeedHeader(params, desiredData,
+                                                eventId)),
            timeout: 15000
          }).success(function (data, status) {
             if (status === 200) {
@@ -259,8 +407,9 @@ angular.module('fbCal').factory('server', function ($log, $http, $wix, api,
             headers: {'X-Wix-Instance' : instance},
             timeout: 10000,
             data: data
-          }).success(function (message, status) {
+          }).success(function (message, status, responseHeaders) {
             if (status === 200) {
+              storeLastWrite(responseHeaders);
               deferred.resolve();
             } else {
               $log.warn('The server is returning an incorrect status.');
@@ -287,8 +436,9 @@ angular.module('fbCal').factory('server', function ($log, $http, $wix, api,
             headers: {'X-Wix-Instance' : instance},
             timeout: 10000,
             data: {}
-          }).success(function (message, status) {
+          }).success(function (message, status, responseHeaders) {
             if (status === 200) {
+              storeLastWrite(responseHeaders);
               deferred.resolve();
             } else {
               $log.warn('The server is returning an incorrect status.');
@@ -303,6 +453,8 @@ angular.module('fbCal').factory('server', function ($log, $http, $wix, api,
 
   return {
     getUserInfo: getUserInfo,
+    getMonthWindow: getMonthWindow,
+    getEventsWindow: getEventsWindow,
     getAllEvents: getAllEvents,
     getModalEvent: getModalEvent,
     getModalFeed: getModalFeed,
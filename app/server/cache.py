@@ -0,0 +1,197 @@
+"""This file defines the caches used to keep data from Facebook and rows from
+the database around between requests so that they do not have to be fetched
+again on every load of the widget.
+
+Two backends are available:
+
+- MemoryCache keeps the data in the memory of the process. It is the fastest
+  but every worker has its own copy and it is empty after every restart.
+- SQLiteCache keeps the data in a SQLite file on the local disk. It is shared
+  by all the workers on the same machine and survives restarts.
+
+The backend is picked with the CACHE_BACKEND environment variable ("memory" or
+"sqlite"). For SQLite, CACHE_PATH sets where the file is kept. By default it is
+kept in a ".fbcal" directory in the home directory of the user running the app.
+The directory and the file can only be read and written by that user, but
+secrets (like access tokens) should still not be stored in a shared backend.
+
+The cache is only there to save work: a backend that cannot be read or written
+(e.g. a SQLite file locked by another worker) acts like an empty cache, so a
+problem with the cache never makes a request fail.
+
+Every entry belongs to a namespace (e.g. "events" or "users") so that all the
+entries of a namespace can be invalidated at once. Values are stored as JSON,
+so only JSON data (like the scrubbed Facebook data) can be cached and every
+get returns a fresh copy that callers can change freely.
+"""
+
+from collections import OrderedDict
+from json import dumps, loads
+from os import environ, getuid
+from threading import Lock, local
+from time import time
+import os
+import os.path
+import sqlite3
+
+__author__ = "Jeffrey Chan"
+
+class MemoryCache(object):
+    """This cache keeps up to "max_entries" entries in memory. When it is full,
+    the least recently used entry is removed to make room. It is only seen by
+    the process it is in.
+    """
+    shared = False
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, namespace, key):
+        """Returns the value stored under the key or None if there is none or
+        it has expired.
+        """
+        with self.lock:
+            entry = self.entries.pop((namespace, key), None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time():
+                return None
+            self.entries[(namespace, key)] = entry
+        return loads(value)
+
+    def set(self, namespace, key, value, ttl):
+        """Stores the value under the key for "ttl" seconds."""
+        entry = (dumps(value), time() + ttl)
+        with self.lock:
+            self.entries.pop((namespace, key), None)
+            self.entries[(namespace, key)] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, namespace, key):
+        """Removes the value stored under the key."""
+        with self.lock:
+            self.entries.pop((namespace, key), None)
+
+    def clear(self, namespace):
+        """Removes all the values stored in the namespace."""
+        with self.lock:
+            for entry_key in list(self.entries):
+                if entry_key[0] == namespace:
+                    del self.entries[entry_key]
+
+
+class SQLiteCache(object):
+    """This cache keeps its entries in a SQLite file that every worker process
+    on the machine can read and write. Each thread uses its own connection.
+
+    Expired entries are not returned and are removed from the file every
+    "prune_every" writes.
+
+    The file uses write ahead logging so that reads are not blocked by writes.
+    A statement that cannot get the file within "timeout" seconds (or fails in
+    any other way) is given up on: gets return None and changes are skipped.
+    A change that is skipped leaves the old entry until it expires.
+
+    The file is created so that only the user running the app can read or
+    write it, and its directory must belong to that user and not be writable
+    by anyone else (otherwise anyone could replace the file).
+    """
+    shared = True
+
+    def __init__(self, path, prune_every=500, timeout=0.1):
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        stat = os.stat(directory)
+        if stat.st_uid != getuid() or stat.st_mode & 0022:
+            raise ValueError("The cache directory " + directory + " must " + \
+                             "belong to this user and not be writable by " + \
+                             "others")
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0600))
+        if os.stat(path).st_uid != getuid():
+            raise ValueError("The cache file " + path + " must belong to " + \
+                             "this user")
+        os.chmod(path, 0600)
+        self.path = path
+        self.prune_every = prune_every
+        self.timeout = timeout
+        self.writes = 0
+        self.local = local()
+
+    def _conn(self):
+        """Returns the connection of the current thread, opening it (and
+        creating the table if needed) on first use.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (namespace TEXT, "
+                         "key TEXT, value TEXT, expires REAL, "
+                         "PRIMARY KEY (namespace, key))")
+            self.local.conn = conn
+        return conn
+
+    def get(self, namespace, key):
+        """Returns the value stored under the key or None if there is none or
+        it has expired.
+        """
+        try:
+            row = self._conn().execute("SELECT value FROM cache WHERE "
+                                       "namespace = ? AND key = ? AND "
+                                       "expires >= ?",
+                                       (namespace, key, time())).fetchone()
+        except sqlite3.Error, e:
+            print e
+            return None
+        if row is None:
+            return None
+        return loads(row[0])
+
+    def set(self, namespace, key, value, ttl):
+        """Stores the value under the key for "ttl" seconds."""
+        try:
+            conn = self._conn()
+            conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                         (namespace, key, dumps(value), time() + ttl))
+            self.writes += 1
+            if self.writes % self.prune_every == 0:
+                conn.execute("DELETE FROM cache WHERE expires < ?", (time(),))
+        except sqlite3.Error, e:
+            print e
+
+    def delete(self, namespace, key):
+        """Removes the value stored under the key."""
+        try:
+            self._conn().execute("DELETE FROM cache WHERE namespace = ? AND "
+                                 "key = ?", (namespace, key))
+        except sqlite3.Error, e:
+            print e
+
+    def clear(self, namespace):
+        """Removes all the values stored in the namespace."""
+        try:
+            self._conn().execute("DELETE FROM cache WHERE namespace = ?",
+                                 (namespace,))
+        except sqlite3.Error, e:
+            print e
+
+
+def make_cache():
+    """Creates the cache picked by the CACHE_BACKEND environment variable.
+    Defaults to an in memory cache.
+    """
+    if environ.get("CACHE_BACKEND") == "sqlite":
+        path = environ.get("CACHE_PATH",
+                           os.path.join(os.path.expanduser("~"), ".fbcal",
+                                        "cache.sqlite"))
+        return SQLiteCache(path,
+                           timeout=float(environ.get("CACHE_TIMEOUT", 0.1)))
+    return MemoryCache(int(environ.get("CACHE_MAX_ENTRIES", 1000)))
+
+cache = make_cache()
@@ -4,20 +4,32 @@ Flask-Restful package.
 """
 
 import json
+from hashlib import sha1
+from time import time
 from flask import request
 from flask.ext.restful import Resource, Api, abort
 from app import flask_app
 from status_codes import STATUS
-from wix_verifications import instance_parser
+from wix_verifications import instance_parser, sign_last_write, \
+                              last_write_parser
 from fb import get_long_term_token, get_event_data, get_user_name, \
-               get_all_event_data, get_specific_event, get_more_feed
-from models import save_settings, get_settings, delete_info
+               get_all_event_data, get_specific_event, get_more_feed, \
+               get_batch_event_data, set_deadline, clear_deadline, \
+               EVENTS_CACHE_TTL, FB_REQUEST_DEADLINE
+from models import save_settings, get_settings, get_settings_batch, \
+                   delete_info, remove_events, set_last_write, \
+                   clear_last_write
+from cache import cache
+from event_months import index_by_month, events_between
 
 __author__ = "Jeffrey Chan"
 
 """Sets up the flask app with the Flask-Restful package"""
 api = Api(flask_app)
 
+"""The maximum number of widgets whose data can be requested in one batch."""
+MAX_BATCH_SIZE = 20
+
 class SaveSettings(Resource):
     """This class handles put requests to save settings to the database."""
     def put(self, compID):
@@ -35,12 +47,26 @@ class GetSettingsWidget(Resource):
     def get(self, compID):
         return get_data(request, compID, True)
 
+class GetSettingsWidgets(Resource):
+    """This class handles get requests for the settings and event data of
+    several widgets on the same site at once.
+    """
+    def get(self):
+        return get_batch_data(request)
+
 class GetSettingsSettings(Resource):
     """This class handles get requests for the settings from the settings panel.
     """
     def get(self, compID):
         return get_data(request, compID, False)
 
+class GetEventsWindow(Resource):
+    """This class handles get requests from the widget in Month view for the
+    events taking place in the months it is showing.
+    """
+    def get(self, compID):
+        return get_window(request, compID)
+
 class GetAllEvents(Resource):
     """This class handles get requests from the settings panel to get event data
     when trying to do so on the client side fails.
@@ -51,6 +77,9 @@ class GetAllEvents(Resource):
 class GetModalEvent(Resource):
     """This class handles all get requests from the modal for basic event data,
     cover photos, the first page of the event feed, as well as guest stats.
+
+    With the event feed, it can also return more pages of comments on the first
+    statuses if the number of pages is given in the "comment_pages" header.
     """
     def get(self, compID):
         return get_event(request, compID, "specific")
@@ -76,18 +105,58 @@ class Logout(Resource):
             abort(STATUS["Internal_Server_Error"], \
                   message="Failed to Logout")
         else:
-            return { "message" : "User Logged Out Successfully"}
+            return { "message" : "User Logged Out Successfully"}, \
+                   STATUS["OK"], last_write_header(info["instance"])
 
 """This sets the URLs of the app's REST API."""
 api.add_resource(SaveSettings, "/SaveSettings/<string:compID>")
 api.add_resource(SaveAccessToken, "/SaveAccessToken/<string:compID>")
 api.add_resource(GetSettingsWidget, "/GetSettingsWidget/<string:compID>")
+api.add_resource(GetSettingsWidgets, "/GetSettingsWidgets")
 api.add_resource(GetSettingsSettings, "/GetSettingsSettings/<string:compID>")
+api.add_resource(GetEventsWindow, "/GetEventsWindow/<string:compID>")
 api.add_resource(GetAllEvents, "/GetAllEvents/<string:compID>")
 api.add_resource(GetModalEvent, "/GetModalEvent/<string:compID>")
 api.add_resource(GetModalFeed, "/GetModalFeed/<string:compID>")
 api.add_resource(Logout, "/Logout/<string:compID>")
 
+@flask_app.before_request
+def start_deadline():
+    """This gives the calls to Facebook made while handling each request
+    FB_REQUEST_DEADLINE seconds to finish, so that a slow Facebook cannot hold
+    up a worker for long.
+    """
+    set_deadline(FB_REQUEST_DEADLINE)
+
+@flask_app.teardown_request
+def end_deadline(exception):
+    """This removes the deadline once the request has been handled."""
+    clear_deadline()
+
+@flask_app.teardown_request
+def end_last_write(exception):
+    """This forgets when the user last wrote once the request has been
+    handled (see read_last_write).
+    """
+    clear_last_write()
+
+def last_write_header(instance):
+    """This function returns the "last_write" header sent back after a write
+    to the instance. The client sends it back with its reads so that they go
+    to the primary database until the read replicas have the write, whichever
+    machine handles them.
+    """
+    return {"last_write" : sign_last_write(instance, time())}
+
+def read_last_write(request, instance):
+    """This function passes on when the user last wrote to the instance, if
+    the request comes with a "last_write" header signed for the instance.
+    """
+    if "last_write" in request.headers:
+        written_at = last_write_parser(instance, request.headers["last_write"])
+        if written_at is not None:
+            set_last_write(written_at)
+
 def validate_put_request(request, datatype):
     """This function validates all put requests to the server.
     
@@ -173,9 +242,14 @@ def validate_get_request(request, request_from):
                     abort(STATUS["Forbidden"], message="Invalid Instance")
             except KeyError:
                 abort(STATUS["Forbidden"], message="Invalid Instance")
+        if request_from == "widgetBatch":
+            comp_ids = [comp_id.strip() for comp_id in \
+                        request.headers["comp_ids"].split(",") if comp_id.strip()]
         if request_from == "modal" or request_from == "modalNeedingMoreFeed":
             event_id = request.headers["event_id"]
             desired_data = request.headers["desired_data"]
+        if request_from == "modal":
+            comment_pages = request.headers.get("comment_pages", "0")
         if request_from == "modalNeedingMoreFeed":
             object_id = request.headers["object_id"]
             if "until" in request.headers:
@@ -188,16 +262,25 @@ def validate_get_request(request, request_from):
         abort(STATUS["Unauthorized"], message="Request Incomplete")
     except KeyError:
         abort(STATUS["Unauthorized"], message="Missing Value")
+    read_last_write(request, instance)
     if request_from == "modal" or request_from == "modalNeedingMoreFeed":
         info = {"instance" : instance, "event_id" : event_id, \
                 "desired_data" : desired_data}
         if not (request_from == "modalNeedingMoreFeed"):
+            try:
+                info["comment_pages"] = int(comment_pages)
+            except ValueError:
+                abort(STATUS["Bad_Request"], message="Badly Formed Request")
             return info
         else:
             info["object_id"] = object_id
             info["until"] = until
             info["after"] = after
             return info
+    elif request_from == "widgetBatch":
+        if not comp_ids or len(comp_ids) > MAX_BATCH_SIZE:
+            abort(STATUS["Bad_Request"], message="Badly Formed Request")
+        return {"instance" : instance, "comp_ids" : comp_ids}
     else:
         return instance
 
@@ -225,7 +308,8 @@ def save_data(request, compID, datatype):
     if not save_settings(compID, info, datatype):
         abort(STATUS["Internal_Server_Error"], message="Could Not Save " + datatype)
     else:
-        return {"message" : "Saved " + datatype + " Successfully"}
+        return {"message" : "Saved " + datatype + " Successfully"}, \
+               STATUS["OK"], last_write_header(info["instance"])
 
 def get_data(request, compID, request_from_widget):
     """This function handles all the getting of data from widget and settings
@@ -240,6 +324,9 @@ def get_data(request, compID, request_from_widget):
     settings), it returns the appropiate data in a JSON format to the 
     client side.
 
+    If the widget is in Month view and asks for a window of time (see
+    parse_window), only the events taking place in that window are returned.
+
     It returns an appropiate error status code and corresponding message if
     anything fails while getting the data.
     """
@@ -258,30 +345,31 @@ def get_data(request, compID, request_from_widget):
         else:
             empty_settings = {"settings" : "", "events" : "", \
                               "active" : "false", "name" : "", "user_id" : ""}
-        empty_json = json.dumps(empty_settings)
-        return empty_json
+        empty_json = json.dumps(empty_settings, sort_keys=True)
+        return conditional_response(request, empty_json)
     else:
-        settings = ""
-        access_token_data = ""
-        events = ""
-        if db_entry.settings:
-            settings = json.loads(db_entry.settings)
-        if db_entry.events:
-            events = json.loads(db_entry.events)
-        if db_entry.access_token_data:
-            access_token_data = json.loads(db_entry.access_token_data)
+        settings, events, access_token_data = parse_entry(db_entry)
         if request_from_widget:
+            window = parse_window(request)
             if access_token_data:
-                fb_event_data = get_event_data(events, access_token_data)
+                if window and (settings or {}).get("view", "Month") == "Month":
+                    index = get_month_index(db_entry, events, access_token_data)
+                    fb_event_data = index and events_between(index, *window)
+                else:
+                    fb_event_data = get_widget_events(db_entry, events, \
+                                                      access_token_data)
+                    window = None
                 if (not fb_event_data) and (fb_event_data != []):
                     abort(STATUS["Bad_Gateway"], 
                         message="Couldn't receive data from Facebook")
-                full_settings = {"settings" : settings, \
-                                 "fb_event_data" : fb_event_data, \
-                                 "active" : "true"}
             else:
-                full_settings = {"settings" : settings, \
-                                 "fb_event_data" : "", "active" : "false"}
+                fb_event_data = ""
+                window = None
+            full_settings = widget_settings(settings, fb_event_data, \
+                                            access_token_data)
+            if window:
+                full_settings["window"] = {"start" : window[0], \
+                                           "end" : window[1]}
         else:
             if access_token_data:
                 user_id = access_token_data["user_id"]
@@ -294,8 +382,188 @@ def get_data(request, compID, request_from_widget):
 
             full_settings = {"settings" : settings, "events" : events, \
                              "active" : active, "name" : name, "user_id" : user_id};
-        full_json = json.dumps(full_settings)
-        return full_json
+        full_json = json.dumps(full_settings, sort_keys=True)
+        return conditional_response(request, full_json)
+
+def get_batch_data(request):
+    """This function handles getting the data of several widgets on the same
+    site (instance) in a single request.
+
+    The instance is verified once and the rows of all the requested component
+    IDs are fetched from the database in one query. The Facebook event data is
+    then retrieved only once per access token no matter how many widgets use
+    it.
+
+    It returns a JSON object mapping each component ID to the same data that
+    GetSettingsWidget would return for it. If the Facebook data could not be
+    retrieved for a widget, its entry only contains an error message so that
+    the other widgets on the page can still be displayed.
+    """
+    info = validate_get_request(request, "widgetBatch")
+    db_entries = get_settings_batch(info["comp_ids"], info["instance"])
+    if db_entries is None:
+        abort(STATUS["Internal_Server_Error"], \
+              message= "Could Not Get Settings")
+    parsed = {}
+    batch = {}
+    for compID in db_entries:
+        parsed[compID] = parse_entry(db_entries[compID])
+        settings, events, access_token_data = parsed[compID]
+        if access_token_data:
+            batch[compID] = (events, access_token_data)
+    fb_event_data = get_batch_event_data(batch)
+    all_settings = {}
+    for compID in info["comp_ids"]:
+        if compID not in parsed:
+            all_settings[compID] = {"settings" : "", \
+                                    "fb_event_data" : "", "active" : "false"}
+            continue
+        settings, events, access_token_data = parsed[compID]
+        if access_token_data:
+            event_data = fb_event_data[compID]
+            if (not event_data) and (event_data != []):
+                all_settings[compID] = \
+                        {"error" : "Couldn't receive data from Facebook"}
+                continue
+        else:
+            event_data = ""
+        all_settings[compID] = widget_settings(settings, event_data, \
+                                               access_token_data)
+    full_json = json.dumps(all_settings, sort_keys=True)
+    return conditional_response(request, full_json)
+
+def get_window(request, compID):
+    """This function handles getting the events of the widget that take place
+    between the start and end times (in milliseconds) given in the
+    "window_start" and "window_end" headers. Without them, all the events of
+    the widget are returned.
+
+    It is used by the widget in Month view to get the events of the months it
+    did not get with its settings.
+    """
+    instance = validate_get_request(request, "widget")
+    window = parse_window(request)
+    db_entry = get_settings(compID, instance)
+    if db_entry is None:
+        abort(STATUS["Internal_Server_Error"], \
+              message= "Could Not Get Events")
+    fb_event_data = []
+    if db_entry:
+        settings, events, access_token_data = parse_entry(db_entry)
+        index = get_month_index(db_entry, events, access_token_data)
+        if index is False:
+            abort(STATUS["Bad_Gateway"],
+                  message="Couldn't receive data from Facebook")
+        if window:
+            fb_event_data = events_between(index, *window)
+        else:
+            fb_event_data = index["events"]
+    window_json = {"fb_event_data" : fb_event_data}
+    if window:
+        window_json["window"] = {"start" : window[0], "end" : window[1]}
+    return conditional_response(request, json.dumps(window_json, \
+                                                    sort_keys=True))
+
+def parse_window(request):
+    """This function returns the start and end times (in milliseconds) given in
+    the "window_start" and "window_end" headers of the request, or None if
+    they were not given.
+    """
+    if not ("window_start" in request.headers and \
+            "window_end" in request.headers):
+        return None
+    try:
+        start = int(request.headers["window_start"])
+        end = int(request.headers["window_end"])
+    except ValueError:
+        abort(STATUS["Bad_Request"], message="Badly Formed Request")
+    if end <= start:
+        abort(STATUS["Bad_Request"], message="Badly Formed Request")
+    return start, end
+
+def get_month_index(db_entry, events, access_token_data):
+    """This function returns the widget's events indexed by the months they
+    take place in (see event_months.py). It returns False if the events could
+    not be retrieved from Facebook.
+
+    The index is cached under a hash of the saved events and access token, so
+    it is rebuilt as soon as the user changes which events are displayed.
+    """
+    if not access_token_data:
+        return index_by_month([])
+    key = sha1((db_entry.instanceID + "/" + db_entry.compID + "/" + \
+                db_entry.events + "/" + db_entry.access_token_data) \
+               .encode("utf-8")).hexdigest()
+    index = cache.get("months", key)
+    if index is None:
+        fb_event_data = get_widget_events(db_entry, events, access_token_data)
+        if (not fb_event_data) and (fb_event_data != []):
+            return False
+        index = index_by_month(fb_event_data)
+        cache.set("months", key, index, EVENTS_CACHE_TTL)
+    return index
+
+def get_widget_events(db_entry, events, access_token_data):
+    """This function gets the Facebook data of the events displayed by the
+    widget. Events that keep failing to be retrieved from Facebook (because
+    they were deleted) are removed from the user's saved events.
+    """
+    dead_events = []
+    fb_event_data = get_event_data(events, access_token_data, dead_events)
+    if dead_events:
+        remove_events(db_entry.compID, db_entry.instanceID, dead_events)
+    return fb_event_data
+
+def parse_entry(db_entry):
+    """This function parses the settings, saved events and access token data
+    stored in a database row. Columns that are empty are returned as empty
+    strings.
+    """
+    settings = ""
+    access_token_data = ""
+    events = ""
+    if db_entry.settings:
+        settings = json.loads(db_entry.settings)
+    if db_entry.events:
+        events = json.loads(db_entry.events)
+    if db_entry.access_token_data:
+        access_token_data = json.loads(db_entry.access_token_data)
+    return settings, events, access_token_data
+
+def widget_settings(settings, fb_event_data, access_token_data):
+    """This function puts together the data the widget needs: its settings,
+    the Facebook event data, and whether or not the user has connected their
+    Facebook account.
+    """
+    if access_token_data:
+        return {"settings" : settings, "fb_event_data" : fb_event_data, \
+                "active" : "true"}
+    else:
+        return {"settings" : settings, "fb_event_data" : "", \
+                "active" : "false"}
+
+def conditional_response(request, body):
+    """This function attaches an ETag to the settings/event data being sent to
+    the widget or settings panel so that the client can revalidate its copy
+    instead of downloading it again on every page view.
+
+    The ETag is a hash of the JSON string itself, so it changes whenever either
+    the saved settings or the Facebook event data change. The keys are sorted
+    when dumping so every worker produces the same hash for the same data.
+
+    If the client already has this version (sent via If-None-Match), an empty
+    304 response is returned. Otherwise, the JSON is returned as usual along
+    with its ETag.
+    """
+    etag = sha1(body).hexdigest()
+    headers = {"Cache-Control": "private, no-cache"}
+    if request.if_none_match.contains(etag):
+        response = flask_app.response_class(status=STATUS["Not_Modified"],
+                                            headers=headers)
+        response.set_etag(etag)
+        return response
+    headers["ETag"] = '"' + etag + '"'
+    return body, STATUS["OK"], headers
 
 def get_event(request, compID, datatype):
     """This function handles all requests from the modal as well as gets event
@@ -349,7 +617,7 @@ def get_event(request, compID, datatype):
         if (found):
             if (datatype == "specific"):
                 event_data = get_specific_event(event_id, access_token, \
-                                            desired_data)
+                                            desired_data, info["comment_pages"])
             else:
                 event_data = get_more_feed(object_id, access_token, \
                                            desired_data, after, until)
@@ -0,0 +1,119 @@
+"""This file sorts the events displayed by the widget into the months they take
+place in. In Month view, the widget only shows one month at a time, so it only
+needs to get the events of that month (and can get the others as the site
+visitor moves through the calendar).
+
+The index built here is a JSON friendly dictionary so it can be cached:
+
+    {"events" : [...],                  the processed events
+     "times" : [[start, end], ...],     their start/end times (milliseconds)
+     "months" : {"2014-07" : [0, 3]}}   the events taking place in each month
+
+Months are in UTC and an event that lasts several months is listed under each
+of them.
+"""
+
+from calendar import timegm
+from datetime import datetime, timedelta
+from re import compile
+import pytz
+
+__author__ = "Jeffrey Chan"
+
+"""Facebook times look like "2014-07-04T19:00:00-0700" or, for events without
+a time, "2014-07-04". Older events may not have a UTC offset, in which case the
+time is in the timezone of the event.
+"""
+time_regex = compile(r"^(\d{4})-(\d{2})-(\d{2})" + \
+                     r"(?:T(\d{2}):(\d{2})(?::(\d{2}))?(?:\.\d+)?" + \
+                     r"(Z|[+-]\d{2}:?\d{2})?)?$")
+
+"""The most months an event is listed under. Events that last longer are only
+listed under their first months.
+"""
+MAX_MONTHS = 24
+
+def parse_time(value, timezone_name):
+    """Returns the Facebook time as a UTC datetime, or None if it cannot be
+    parsed.
+    """
+    match = time_regex.match(value or "")
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, offset = match.groups()
+    try:
+        time = datetime(int(year), int(month), int(day), int(hour or 0),
+                        int(minute or 0), int(second or 0))
+    except ValueError:
+        return None
+    if offset == "Z":
+        return pytz.utc.localize(time)
+    elif offset:
+        offset = offset.replace(":", "")
+        delta = timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5]))
+        if offset[0] == "+":
+            time = time - delta
+        else:
+            time = time + delta
+        return pytz.utc.localize(time)
+    try:
+        timezone = pytz.timezone(timezone_name) if timezone_name else pytz.utc
+    except pytz.UnknownTimeZoneError:
+        timezone = pytz.utc
+    return timezone.localize(time).astimezone(pytz.utc)
+
+def to_milliseconds(time):
+    """Returns the UTC datetime as milliseconds since the epoch (the format the
+    calendar uses).
+    """
+    return timegm(time.utctimetuple()) * 1000
+
+def from_milliseconds(milliseconds):
+    """Returns the milliseconds since the epoch as a UTC datetime."""
+    return pytz.utc.localize(datetime.utcfromtimestamp(milliseconds / 1000.0))
+
+def months_between(start, end):
+    """Returns the keys ("YYYY-MM") of the months from the start time to the end
+    time, with at most MAX_MONTHS of them.
+    """
+    months = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month) and \
+          len(months) < MAX_MONTHS:
+        months.append("%04d-%02d" % (year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+def index_by_month(events):
+    """Builds the index of the events by the months they take place in. Events
+    whose start time cannot be parsed are left out since the calendar cannot
+    place them anyway.
+    """
+    index = {"events" : [], "times" : [], "months" : {}}
+    for event in events:
+        timezone_name = event.get("timezone")
+        start = parse_time(event.get("start_time"), timezone_name)
+        if start is None:
+            continue
+        end = parse_time(event.get("end_time"), timezone_name)
+        if end is None or end < start:
+            end = start
+        position = len(index["events"])
+        index["events"].append(event)
+        index["times"].append([to_milliseconds(start), to_milliseconds(end)])
+        for month in months_between(start, end):
+            index["months"].setdefault(month, []).append(position)
+    return index
+
+def events_between(index, start, end):
+    """Returns the events of the index that take place (even partly) between
+    the start and end times (in milliseconds).
+    """
+    positions = set()
+    months = months_between(from_milliseconds(start),
+                            from_milliseconds(max(start, end - 1)))
+    for month in months:
+        positions.update(index["months"].get(month, []))
+    return [index["events"][position] for position in sorted(positions) \
+            if index["times"][position][0] < end and \
+               index["times"][position][1] >= start]
@@ -1,10 +1,20 @@
 """This file handles all interactions with Facebook on the server."""
 
+from collections import deque
+from hashlib import sha1
+from httplib import HTTPException
 from json import loads
+from multiprocessing.pool import ThreadPool
 from os import environ
+from Queue import Queue, Empty
 from re import compile, sub
-from time import time
+from threading import Lock, Thread, local
+from time import time, sleep
+from urllib import urlencode
+from urllib2 import urlopen, HTTPError
+from urlparse import parse_qs
 import facebook
+from cache import cache
 from models import get_settings
 
 if "HEROKU" in environ:
@@ -19,6 +29,433 @@ else:
 
 __author__ = "Jeffrey Chan"
 
+"""How long (in seconds) event data from Facebook is kept in the cache."""
+EVENTS_CACHE_TTL = int(environ.get("EVENTS_CACHE_TTL", 60))
+
+"""When an event saved by the user cannot be retrieved from Facebook (it was
+deleted or is no longer accessible), it is not looked up again for
+MISSING_EVENT_TTL seconds. This time doubles with each failure in a row, up to
+MISSING_EVENT_MAX_TTL. If PRUNE_MISSING_EVENTS is set, events that failed
+MISSING_EVENT_PRUNE_AFTER times in a row are removed from the user's events.
+"""
+MISSING_EVENT_TTL = int(environ.get("MISSING_EVENT_TTL", 60))
+MISSING_EVENT_MAX_TTL = int(environ.get("MISSING_EVENT_MAX_TTL", 60 * 60 * 24))
+MISSING_EVENT_PRUNE_AFTER = int(environ.get("MISSING_EVENT_PRUNE_AFTER", 5))
+PRUNE_MISSING_EVENTS = environ.get("PRUNE_MISSING_EVENTS") == "true"
+
+"""Graph API error codes Facebook replies with when an object does not exist
+(or cannot be seen with the access token).
+"""
+MISSING_EVENT_CODES = (100, 803)
+
+"""The fields requested from Facebook for each kind of event data. Only the
+fields that the client actually displays are requested so that less data is
+transferred, parsed and scrubbed. The widget and settings panel never show
+locations, so those are not even requested for them.
+"""
+WIDGET_EVENT_FIELDS = "id,name,start_time,end_time,timezone"
+SETTINGS_EVENT_FIELDS = "id,name,start_time"
+MODAL_EVENT_FIELDS = "id,name,owner,description,start_time,end_time," + \
+                     "timezone,location,venue"
+
+"""Priorities of the calls made to Facebook. Widget and modal traffic is what
+site visitors see, so it is high priority. Work done for the settings panel
+that can be retried later (e.g. get_all_event_data) is low priority.
+"""
+HIGH_PRIORITY = "high"
+LOW_PRIORITY = "low"
+
+"""Graph API error codes that mean a rate limit has been hit. Code 4 is the
+limit of the app as a whole. The others are limits of a single user/token.
+"""
+APP_THROTTLE_CODES = (4,)
+TOKEN_THROTTLE_CODES = (17, 32, 613)
+
+"""Graph API error codes that mean Facebook itself is having trouble (an
+unknown error or the service being unavailable) rather than something being
+wrong with our call.
+"""
+SERVICE_ERROR_CODES = (1, 2)
+
+"""How long (in seconds) a single call to Facebook may take, and how long all
+the calls made while handling one request to our server may take together
+(see set_deadline).
+"""
+FB_CALL_TIMEOUT = float(environ.get("FB_CALL_TIMEOUT", 5))
+FB_REQUEST_DEADLINE = float(environ.get("FB_REQUEST_DEADLINE", 10))
+
+"""If a call for the widget's events has not come back after FB_HEDGE_AFTER
+seconds, a second identical call is made and whichever comes back first is
+used. 0 turns this off.
+"""
+FB_HEDGE_AFTER = float(environ.get("FB_HEDGE_AFTER", 0))
+
+"""The most pages of events get_event_info goes through for one request."""
+MAX_EVENT_PAGES = int(environ.get("MAX_EVENT_PAGES", 20))
+
+"""When the modal asks for the event feed, it can also ask for more pages of
+comments on the first PREFETCH_STATUSES statuses (the ones it shows first), up
+to MAX_COMMENT_PAGES pages per status.
+"""
+PREFETCH_STATUSES = 5
+MAX_COMMENT_PAGES = 3
+
+"""After FB_BREAKER_FAILURES failed calls in a row (timeouts or Facebook
+service errors), no calls are made to Facebook for FB_BREAKER_RESET seconds.
+Meanwhile, the widget is shown the last event data that was retrieved, which is
+kept for STALE_EVENTS_TTL seconds.
+"""
+FB_BREAKER_FAILURES = int(environ.get("FB_BREAKER_FAILURES", 5))
+FB_BREAKER_RESET = int(environ.get("FB_BREAKER_RESET", 30))
+STALE_EVENTS_TTL = int(environ.get("STALE_EVENTS_TTL", 60 * 60 * 24))
+
+class RateLimitError(facebook.GraphAPIError):
+    """This error is raised when a call to Facebook is not made because the
+    call budget of the access token or app is used up or because Facebook told
+    us to back off. It is a GraphAPIError so it is handled everywhere a
+    Facebook error already is.
+    """
+    def __init__(self, message):
+        facebook.GraphAPIError.__init__(self, {"error" : {"message" : message,
+                                                          "code" : 4}})
+
+class GraphUnavailableError(facebook.GraphAPIError):
+    """This error is raised when Facebook does not respond in time, cannot be
+    reached, or is not called at all because it has been failing (see
+    CircuitBreaker). Like RateLimitError, it is a GraphAPIError so it is
+    handled everywhere a Facebook error already is.
+    """
+    def __init__(self, message):
+        facebook.GraphAPIError.__init__(self, {"error" : {"message" : message,
+                                                          "code" : 2}})
+
+class GraphScheduler(object):
+    """This class keeps track of how many calls have been made to Facebook in
+    the last hour (the window), both per access token and for the app as a
+    whole, and decides whether a new call can be made.
+
+    High priority calls are made as long as there is budget left. If there is
+    none, they wait up to "max_wait" seconds for budget to free up before
+    giving up. Low priority calls never wait and are shed as soon as
+    "low_priority_share" of a budget is used up, keeping the rest of the budget
+    for the widget.
+
+    When Facebook replies with a rate limit error, the access token (or the
+    whole app) is backed off exponentially: no calls are made for "base_backoff"
+    seconds, doubling with each consecutive rate limit error up to
+    "max_backoff". A successful call resets the backoff.
+
+    Calls made with one of the "app_tokens" (the app access token, used for
+    e.g. /debug_token on behalf of every user) only count against the budget of
+    the app, since they are not made for any single user.
+
+    A budget of None means there is no limit: only the backoff after rate limit
+    errors from Facebook applies. Calls are counted by each process on its own,
+    so the budgets are per process (not per app across all workers).
+
+    The clock and sleep functions can be replaced to simulate throttling
+    without waiting in real time.
+    """
+    def __init__(self, token_budget=None, app_budget=100000, window=3600,
+                 low_priority_share=0.8, max_wait=2, base_backoff=1,
+                 max_backoff=600, clock=time, sleep=sleep, app_tokens=()):
+        self.budgets = {"token" : token_budget, "app" : app_budget}
+        self.app_tokens = app_tokens
+        self.window = window
+        self.low_priority_share = low_priority_share
+        self.max_wait = max_wait
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = Lock()
+        self.calls = {}
+        self.backoffs = {}
+
+    def acquire(self, access_token, priority):
+        """Records a call about to be made with the access token. It raises a
+        RateLimitError if the call should not be made.
+        """
+        if access_token in self.app_tokens:
+            keys = (("app", "app"),)
+        else:
+            keys = (("app", "app"), ("token", token_key(access_token)))
+        give_up = self.clock() + self.max_wait
+        while True:
+            with self.lock:
+                wait = self._wait_time(keys, priority)
+                if wait == 0:
+                    for kind, key in keys:
+                        if self.budgets[kind] is not None:
+                            self.calls.setdefault(key, deque()) \
+                                      .append(self.clock())
+                    return
+            if priority == LOW_PRIORITY or self.clock() + wait > give_up:
+                raise RateLimitError("Facebook call budget used up")
+            self.sleep(wait)
+
+    def _wait_time(self, keys, priority):
+        """Returns how many seconds to wait before a call can be made with the
+        given keys (0 if it can be made now). Must be called with the lock.
+        """
+        now = self.clock()
+        wait = 0
+        for kind, key in keys:
+            backoff_until = self.backoffs.get(key, (0, 0))[0]
+            wait = max(wait, backoff_until - now)
+            calls = self.calls.get(key)
+            if calls is None:
+                continue
+            while calls and calls[0] <= now - self.window:
+                calls.popleft()
+            if not calls:
+                del self.calls[key]
+                continue
+            budget = self.budgets[kind]
+            if budget is None:
+                continue
+            if priority == LOW_PRIORITY:
+                budget = max(1, int(budget * self.low_priority_share))
+            if len(calls) >= budget:
+                wait = max(wait, calls[len(calls) - budget] + self.window - now)
+        return max(wait, 0)
+
+    def record_success(self, access_token):
+        """Resets the backoff of the access token and the app."""
+        with self.lock:
+            self.backoffs.pop(token_key(access_token), None)
+            self.backoffs.pop("app", None)
+
+    def record_error(self, access_token, error):
+        """Backs off the access token or the whole app if the error from
+        Facebook says a rate limit was hit. Rate limits on an app token back
+        off the whole app.
+        """
+        code = error_code(error)
+        if code in APP_THROTTLE_CODES or \
+           (code in TOKEN_THROTTLE_CODES and access_token in self.app_tokens):
+            key = "app"
+        elif code in TOKEN_THROTTLE_CODES:
+            key = token_key(access_token)
+        else:
+            return
+        with self.lock:
+            failures = self.backoffs.get(key, (0, 0))[1] + 1
+            backoff = min(self.max_backoff,
+                          self.base_backoff * (2 ** (failures - 1)))
+            self.backoffs[key] = (self.clock() + backoff, failures)
+
+def call_budget(name, default):
+    """Returns the call budget set in the environment variable, or the default
+    if it is not set. An empty value means no limit.
+    """
+    value = environ.get(name, default)
+    return int(value) if value not in (None, "") else None
+
+"""The per user budget is off unless FB_TOKEN_CALL_BUDGET is set, since
+Facebook's own per user limit is far higher than what one user of the app
+needs; rate limit errors from Facebook still back the user off.
+"""
+scheduler = GraphScheduler(
+                token_budget=call_budget("FB_TOKEN_CALL_BUDGET", None),
+                app_budget=call_budget("FB_APP_CALL_BUDGET", 100000),
+                app_tokens=(fb_app_access_token,))
+
+class CircuitBreaker(object):
+    """This class stops calls from being made to Facebook while it is failing,
+    so that workers fail fast instead of all waiting on it.
+
+    After "failure_threshold" failed calls in a row, the breaker opens and
+    every call fails right away with a GraphUnavailableError. Once
+    "reset_timeout" seconds have passed, a single trial call is let through.
+    If it succeeds, the breaker closes and calls are made as usual. If it
+    fails, the breaker stays open for another "reset_timeout" seconds.
+
+    Only timeouts, network errors and Facebook service errors count as
+    failures. Any other reply from Facebook (even an error) shows that it is
+    up.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.lock = Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def before_call(self):
+        """Raises a GraphUnavailableError if the call should not be made."""
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.trial or \
+               self.clock() < self.opened_at + self.reset_timeout:
+                raise GraphUnavailableError("Facebook is failing, call skipped")
+            self.trial = True
+
+    def cancel_call(self):
+        """Notes that a call let through by before_call was not made."""
+        with self.lock:
+            self.trial = False
+
+    def record_success(self):
+        """Closes the breaker."""
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        """Counts a failed call, opening the breaker if there were too many in
+        a row (or if the trial call failed).
+        """
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.opened_at is not None or \
+               self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+
+breaker = CircuitBreaker(FB_BREAKER_FAILURES, FB_BREAKER_RESET)
+
+"""The deadline of the request being handled by each thread."""
+request_state = local()
+
+def set_deadline(seconds):
+    """Gives the calls to Facebook made by the current thread "seconds" seconds
+    to finish, all together. It is set at the start of every request to our
+    server.
+    """
+    request_state.deadline = time() + seconds
+
+def clear_deadline():
+    """Removes the deadline of the current thread."""
+    request_state.deadline = None
+
+def call_timeout():
+    """Returns how long the next call to Facebook may take: FB_CALL_TIMEOUT
+    seconds, or less if the deadline of the request is closer. It raises a
+    GraphUnavailableError if the deadline has already passed.
+    """
+    deadline = getattr(request_state, "deadline", None)
+    if deadline is None:
+        return FB_CALL_TIMEOUT
+    remaining = deadline - time()
+    if remaining <= 0:
+        raise GraphUnavailableError("Request deadline passed")
+    return min(FB_CALL_TIMEOUT, remaining)
+
+def token_key(access_token):
+    """Returns a short hash of the access token so that the token itself is
+    never kept around as a key.
+    """
+    return sha1(access_token).hexdigest()
+
+def error_code(error):
+    """Returns the Graph API error code of a GraphAPIError (None if the error
+    does not have one).
+    """
+    try:
+        return error.result["error"]["code"]
+    except (AttributeError, KeyError, TypeError):
+        return None
+
+def is_temporary(error):
+    """Returns whether the GraphAPIError will likely go away on its own (a rate
+    limit, ours or Facebook's, a timeout or trouble on Facebook's side) rather
+    than being caused by what was asked for.
+    """
+    return isinstance(error, RateLimitError) or \
+           error_code(error) in SERVICE_ERROR_CODES + APP_THROTTLE_CODES + \
+                                TOKEN_THROTTLE_CODES
+
+def graph_get(access_token, path, priority=HIGH_PRIORITY, **args):
+    """This function makes a get request to the Graph API with the access
+    token. All calls to Facebook go through here so that they are counted by
+    the scheduler and backed off when Facebook rate limits us.
+
+    Every call has a timeout (see call_timeout) and is skipped while the
+    circuit breaker is open. Timeouts and network errors are raised as
+    GraphUnavailableErrors.
+    """
+    return graph_call(access_token, priority,
+                      lambda timeout: facebook.GraphAPI(access_token, timeout) \
+                                              .get_object(path, **args))
+
+def graph_call(access_token, priority, call):
+    """This function makes a call to Facebook with the access token, counting
+    it in the scheduler and the circuit breaker. "call" is given the timeout of
+    the call and makes it.
+
+    Timeouts, network errors and replies that cannot be read (e.g. the HTML
+    error page of a failing Facebook server) are raised as
+    GraphUnavailableErrors. Every way the call can end is reported to the
+    breaker, so a trial call always closes or reopens it.
+    """
+    timeout = call_timeout()
+    breaker.before_call()
+    try:
+        scheduler.acquire(access_token, priority)
+        data = call(timeout)
+    except RateLimitError:
+        breaker.cancel_call()
+        raise
+    except facebook.GraphAPIError, e:
+        scheduler.record_error(access_token, e)
+        if error_code(e) in SERVICE_ERROR_CODES:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    except (IOError, HTTPException), e:
+        breaker.record_failure()
+        raise GraphUnavailableError("Facebook did not respond: " + str(e))
+    except ValueError, e:
+        breaker.record_failure()
+        raise GraphUnavailableError("Facebook's reply could not be read: " + \
+                                    str(e))
+    except Exception:
+        breaker.record_failure()
+        raise
+    scheduler.record_success(access_token)
+    breaker.record_success()
+    return data
+
+def hedged_graph_get(access_token, path, priority=HIGH_PRIORITY, **args):
+    """This function makes the same get request as graph_get, but if Facebook
+    has not replied after FB_HEDGE_AFTER seconds, it makes the request a second
+    time and uses whichever reply comes first. A single slow Facebook server
+    then does not hold up the widget. It is only used for the widget's events
+    since the second request costs another call.
+    """
+    if FB_HEDGE_AFTER <= 0:
+        return graph_get(access_token, path, priority, **args)
+    replies = Queue()
+    deadline = getattr(request_state, "deadline", None)
+    def call():
+        request_state.deadline = deadline
+        try:
+            replies.put((True, graph_get(access_token, path, priority,
+                                         **args)))
+        except Exception, e:
+            replies.put((False, e))
+    def start():
+        thread = Thread(target=call)
+        thread.daemon = True
+        thread.start()
+    start()
+    try:
+        reply = replies.get(timeout=FB_HEDGE_AFTER)
+    except Empty:
+        start()
+        reply = replies.get()
+        if not reply[0]:
+            reply = replies.get()
+    if reply[0]:
+        return reply[1]
+    raise reply[1]
+
 def get_long_term_token(short_token, compID, instance):
     """This function gets takes in a short term access token and trades it to
     Facebook for a long term access token (expires in about 2 months).
@@ -35,9 +472,8 @@ def get_long_term_token(short_token, compID, instance):
     before updating the database entry.  
     """
     try:
-        graph = facebook.GraphAPI(fb_app_access_token)
-        verify = graph.get_object("/debug_token", input_token = short_token, \
-                                  access_token = fb_app_access_token)
+        verify = graph_get(fb_app_access_token, "/debug_token",
+                           input_token = short_token)
         verify_data = verify['data']
         if (verify_data["is_valid"] and (verify_data["app_id"] == fb_app)):
             user = get_settings(compID, instance)
@@ -45,8 +481,9 @@ def get_long_term_token(short_token, compID, instance):
                 access_token_data = loads(user.access_token_data)
                 if not access_token_data["user_id"] == verify_data["user_id"]:
                   return "Invalid Access Token"
-            graph = facebook.GraphAPI(short_token)
-            long_token = graph.extend_access_token(fb_app, fb_secret)
+            long_token = graph_call(short_token, HIGH_PRIORITY,
+                                    lambda timeout: extend_access_token(
+                                                        short_token, timeout))
             long_token["generated_time"] = str(int(time()))
             long_token["user_id"] = verify_data["user_id"]
             return long_token
@@ -54,21 +491,118 @@ def get_long_term_token(short_token, compID, instance):
         print e.message
         return "Facebook Error"
 
+def extend_access_token(short_token, timeout):
+    """This function trades the short term access token to Facebook for a long
+    term one. It does what GraphAPI.extend_access_token does, but with a
+    timeout (the facebook package does not give that call one).
+    """
+    args = {"client_id" : fb_app, "client_secret" : fb_secret,
+            "grant_type" : "fb_exchange_token",
+            "fb_exchange_token" : short_token}
+    try:
+        response = urlopen("https://graph.facebook.com/oauth/access_token?" + \
+                           urlencode(args), timeout=timeout).read()
+    except HTTPError, e:
+        raise facebook.GraphAPIError(loads(e.read()))
+    query_str = parse_qs(response)
+    if "access_token" in query_str:
+        result = {"access_token" : query_str["access_token"][0]}
+        if "expires" in query_str:
+            result["expires"] = query_str["expires"][0]
+        return result
+    raise facebook.GraphAPIError(loads(response))
+
 until_regex = compile("until=([0-9]+)")
 after_regex = compile("after=([0-9A-Za-z=]+)")
 
-def get_event_data(events_info, access_token_data):
+def get_event_data(events_info, access_token_data, dead_events=None):
     """This function gets all of the data of the events created by the user on
     Facebook that the user wants to display on her calendar or list. It is used
     on every load of the widget.
+
+    If a list is given as "dead_events", the IDs of the events that should be
+    removed from the user's events (see get_missing_event) are added to it.
     """
-    data = get_event_info("", access_token_data["access_token"], len(events_info))
+    data = get_cached_event_info(access_token_data["access_token"],
+                                 len(events_info))
     if (data) or (data == []):
-        return process_event_data(events_info, data, access_token_data["access_token"])
+        return process_event_data(events_info, data,
+                                  access_token_data["access_token"],
+                                  dead_events)
     else:
         return False
 
-def get_event_info(since, access_token, events_length):
+def get_batch_event_data(batch):
+    """This function gets the event data for several widgets at once. It is
+    used when a page has more than one instance of the widget on it.
+
+    "batch" maps each component ID to the events the user wants on that widget
+    and the access token data saved for it. Widgets on the same site usually
+    share the same access token, so the events created by the user are only
+    retrieved from Facebook once per access token and then processed for each
+    widget separately. Each widget processes its own copy of the events since
+    processing adds that widget's event colors to them.
+
+    It returns a dictionary mapping each component ID to its processed event
+    data (or False if getting the data from Facebook failed).
+    """
+    events_lengths = {}
+    for compID in batch:
+        events_info, access_token_data = batch[compID]
+        access_token = access_token_data["access_token"]
+        events_lengths[access_token] = max(len(events_info),
+                                           events_lengths.get(access_token, 0))
+    fetched = {}
+    for access_token in events_lengths:
+        fetched[access_token] = get_cached_event_info(access_token,
+                                               events_lengths[access_token])
+    processed = {}
+    for compID in batch:
+        events_info, access_token_data = batch[compID]
+        access_token = access_token_data["access_token"]
+        data = fetched[access_token]
+        if (data) or (data == []):
+            data = [dict(event) for event in data]
+            processed[compID] = process_event_data(events_info, data,
+                                                   access_token)
+        else:
+            processed[compID] = False
+    return processed
+
+def get_cached_event_info(access_token, events_length):
+    """This function returns the events created by the user from the cache if
+    they were retrieved recently enough. Otherwise, it gets them from Facebook
+    with get_event_info and caches them.
+
+    The events are scrubbed of the access token before being cached. Since
+    get_event_info retrieves more events when the user has more saved events,
+    the cached events are only used if they were retrieved for at least as
+    many saved events.
+
+    A copy of the events is also kept for STALE_EVENTS_TTL seconds. If Facebook
+    is failing or we are being rate limited, that copy is returned instead so
+    that the widget still shows the events.
+    """
+    key = token_key(access_token)
+    cached = cache.get("events", key)
+    if cached is not None and cached["events_length"] >= events_length:
+        return cached["data"]
+    try:
+        data = get_event_info("", access_token, events_length, hedge=True)
+    except facebook.GraphAPIError, e:
+        stale = cache.get("stale", key)
+        return stale["data"] if stale is not None else False
+    if data is False:
+        return False
+    data = clean_data_list(data)
+    entry = {"events_length" : events_length, "data" : data}
+    cache.set("events", key, entry, EVENTS_CACHE_TTL)
+    cache.set("stale", key, entry, STALE_EVENTS_TTL)
+    return data
+
+def get_event_info(since, access_token, events_length,
+                   priority=HIGH_PRIORITY, fields=WIDGET_EVENT_FIELDS,
+                   hedge=False):
     """This function gets all the event data of the user from Facebook, but it
     only gets data for events that started "since" seconds ago. When "since" is
     not provided, it gets as many event as possible. 
@@ -80,16 +614,29 @@ def get_event_info(since, access_token, events_length):
     The function works by paging through the event data from Facebook and
     storing it all in "final_event_data". Because Facebook's data is across
     multiple pages, the while loop is used. 
+
+    Only the given fields of each event are retrieved (by default, the ones the
+    widget displays). At most MAX_EVENT_PAGES pages are retrieved, and if
+    "hedge" is set they are retrieved with hedged_graph_get.
+
+    If Facebook fails for a temporary reason (see is_temporary), the error is
+    raised so that the caller can fall back on older data. Otherwise, False is
+    returned on Facebook errors.
     """
     final_event_data = [];
     next_page = True;
-    graph = facebook.GraphAPI(access_token)
     after = ""
     until = ""
+    pages = 0
+    get = hedged_graph_get if hedge else graph_get
     while(next_page):
-        events = graph.get_object("/me/events/created", since=since, after=after, until=until)
         try:
+            events = get(access_token, "/me/events/created", priority,
+                         since=since, after=after, until=until, fields=fields)
             final_event_data += events["data"]
+            pages += 1
+            if pages >= MAX_EVENT_PAGES:
+                next_page = False
             if (not since) and len(final_event_data) > 100 and len(final_event_data) > (events_length * 2):
                 next_page = False
             if events["paging"]:
@@ -118,6 +665,8 @@ def get_event_info(since, access_token, events_length):
         except facebook.GraphAPIError, e:
             print "FACEBOOK ERROR " + e.message
             next_page = False
+            if is_temporary(e):
+                raise
             return False
         except Exception, e:
             print "ERROR " + e.message
@@ -125,61 +674,172 @@ def get_event_info(since, access_token, events_length):
             return final_event_data
     return final_event_data
 
-def process_event_data(events_info, event_data, access_token):
+def process_event_data(events_info, event_data, access_token,
+                       dead_events=None):
     """This function processes all the event data from Facebook.
     
     For the safety of the user, location data is removed from all events. Since
     this data is only used in the widget, location data isn't necessary
-    anyways.
+    anyways. (It is not requested from Facebook in the first place, but it is
+    removed here as well in case it is ever returned.)
 
     In addition, all events that are not on the list of events that the user
     wants on her calendar or list are removed here.
 
     Lastly, if there are any events on the user's list that we failed to get the
     data for already, we make sure to get that event data by calling
-    get_specific_event.
+    get_missing_event.
     """
     processed_events = []
     for saved_event in events_info:
         cur_event_data = next((event for event in event_data if event["id"] == saved_event["eventId"]), None)
         if cur_event_data is None:
-            cur_event_data = get_specific_event(saved_event["eventId"], access_token, "all")
+            cur_event_data = get_missing_event(saved_event["eventId"],
+                                               access_token, dead_events)
         if cur_event_data:
             cur_event_data = clean_data_dict(cur_event_data)
-            cur_event_data["location"] = ""
-            cur_event_data["venue"] = ""
+            cur_event_data.pop("location", None)
+            cur_event_data.pop("venue", None)
             cur_event_data["eventColor"] = saved_event["eventColor"]
             processed_events.append(cur_event_data)
     return processed_events
 
-def get_specific_event(eventId, access_token, desired_data):
+def get_missing_event(eventId, access_token, dead_events=None):
+    """This function gets the data the widget needs for a saved event that was
+    not among the events retrieved for the user (e.g. it is too old or it was
+    deleted on Facebook).
+
+    Failed lookups are remembered so that an event that was deleted does not
+    cost a call to Facebook on every load of the widget. After a failure, the
+    event is not looked up again for MISSING_EVENT_TTL seconds, doubling with
+    every failure in a row. Only failures saying that the event does not exist
+    (see is_missing) are counted. Others (e.g. rate limits or Facebook being
+    down) say nothing about the event.
+
+    Once an event has failed MISSING_EVENT_PRUNE_AFTER times in a row, its ID
+    is added to "dead_events" (if pruning is turned on) so that the caller can
+    remove it from the user's events.
+
+    It returns the event data, or {} if there is none.
+    """
+    key = eventId + "/" + token_key(access_token)
+    missing = cache.get("missing", key)
+    if missing and missing["retry_at"] > time():
+        return {}
+    try:
+        data = graph_get(access_token, "/" + eventId,
+                         fields=WIDGET_EVENT_FIELDS)
+        if missing:
+            cache.delete("missing", key)
+        return clean_data_dict(data)
+    except facebook.GraphAPIError, e:
+        print "FACEBOOK ERROR " + e.message
+        if not is_missing(e):
+            return {}
+    failures = missing["failures"] + 1 if missing else 1
+    ttl = min(MISSING_EVENT_MAX_TTL, MISSING_EVENT_TTL * (2 ** (failures - 1)))
+    cache.set("missing", key, {"failures" : failures,
+                               "retry_at" : time() + ttl},
+              MISSING_EVENT_MAX_TTL * 2)
+    if PRUNE_MISSING_EVENTS and failures >= MISSING_EVENT_PRUNE_AFTER and \
+       dead_events is not None:
+        dead_events.append(eventId)
+    return {}
+
+def is_missing(error):
+    """Returns whether the GraphAPIError says that the object asked for does
+    not exist.
+    """
+    return error_code(error) in MISSING_EVENT_CODES or \
+           "does not exist" in unicode(error.message)
+
+def get_specific_event(eventId, access_token, desired_data, comment_pages=0):
     """This function gets all the desired data for a specific event.
 
     This function can get all the basic data for an event as well as get the
-    cover photo, guest stats, and feed for an event.
+    cover photo, guest stats, and feed for an event. For the feed, up to
+    "comment_pages" more pages of comments are added to the top statuses (see
+    prefetch_comments).
 
-    This function is used primarily by the modal, but also sometimes by the
-    widget if an event's data could not be retrieved in the mass retrieval
-    process.
+    This function is used by the modal. (The widget uses get_missing_event if
+    an event's data could not be retrieved in the mass retrieval process.)
     """
     try:
         url = "/" + eventId
-        graph = facebook.GraphAPI(access_token)
         if desired_data == "cover":
-            data = graph.get_object(url, fields="cover")
+            data = graph_get(access_token, url, fields="cover")
         elif desired_data == "guests":
             query = "SELECT attending_count, unsure_count, not_replied_count from event WHERE eid = " + eventId
-            data = graph.get_object("/fql", q=query)
+            data = graph_get(access_token, "/fql", q=query)
         elif desired_data == 'feed':
-            data = graph.get_object(url + "/feed")
+            data = graph_get(access_token, url + "/feed")
+            if comment_pages > 0:
+                data = prefetch_comments(data, access_token, comment_pages)
         else:
-            data = graph.get_object(url)
+            data = graph_get(access_token, url, fields=MODAL_EVENT_FIELDS)
         data = clean_data_dict(data)
         return data
     except facebook.GraphAPIError, e:
         print "FACEBOOK ERROR " + e.message
         return {}
 
+def prefetch_comments(feed, access_token, pages):
+    """This function adds the next "pages" pages of comments (at most
+    MAX_COMMENT_PAGES) to each of the first PREFETCH_STATUSES statuses of the
+    feed that have more comments, so that the modal does not have to ask for
+    them one status at a time.
+
+    The pages of the different statuses are retrieved at the same time. The
+    comments of each page are added to the comments of the status and the
+    paging of the status is replaced by the paging of its last page, so the
+    modal can still get the pages after those. If a page cannot be retrieved,
+    the status is left with the pages it has.
+
+    The feed is not scrubbed here. It is scrubbed once (with the comments
+    added) by the caller.
+    """
+    pages = min(pages, MAX_COMMENT_PAGES)
+    statuses = [status for status in feed.get("data", [])[:PREFETCH_STATUSES] \
+                if type(status.get("comments")) is dict and \
+                   next_comments_cursor(status["comments"])]
+    if not statuses:
+        return feed
+    deadline = getattr(request_state, "deadline", None)
+    def fetch(status):
+        request_state.deadline = deadline
+        comments = status["comments"]
+        for page in range(pages):
+            after = next_comments_cursor(comments)
+            if not after:
+                return
+            try:
+                more = graph_get(access_token,
+                                 "/" + status["id"] + "/comments", after=after)
+            except facebook.GraphAPIError, e:
+                print "FACEBOOK ERROR " + e.message
+                return
+            comments["data"] = comments.get("data", []) + more.get("data", [])
+            comments["paging"] = more.get("paging", {})
+    pool = ThreadPool(len(statuses))
+    try:
+        pool.map(fetch, statuses)
+    finally:
+        pool.close()
+    return feed
+
+def next_comments_cursor(comments):
+    """This function returns the "after" paging token of the next page of
+    comments, or None if there is no next page.
+    """
+    paging = comments.get("paging") or {}
+    if not paging.get("next"):
+        return None
+    cursors = paging.get("cursors") or {}
+    if cursors.get("after"):
+        return cursors["after"]
+    after_pattern = after_regex.search(paging["next"])
+    return after_pattern.group(1) if after_pattern else None
+
 def clean_data_dict(data):
     """This function removes the access token from all data returned from
     Facebook. 
@@ -227,7 +887,8 @@ def get_all_event_data(access_token_data):
     preference and best judgement.
 
     This function is only used by the settings panel and only used when getting
-    event data on the client side fails.
+    event data on the client side fails. Its calls to Facebook are low priority
+    so they are the first to be shed when we are close to a rate limit.
     """
 
     try:
@@ -235,7 +896,10 @@ def get_all_event_data(access_token_data):
         seconds_in_three_months = 60 * 60 * 24 * 90
         time_three_months_ago = str(cur_time - seconds_in_three_months)
         event_info = get_event_info(time_three_months_ago,
-                              access_token_data["access_token"], 0)
+                              access_token_data["access_token"], 0,
+                              LOW_PRIORITY, SETTINGS_EVENT_FIELDS)
+        if event_info is False:
+            return False
         for i in range(0, len(event_info)):
             event_info[i] = clean_data_dict(event_info[i])
         return event_info
@@ -248,8 +912,7 @@ def get_user_name(access_token_data):
     to show whose Facebook account is logged into the app.
     """
     try:
-        graph = facebook.GraphAPI(access_token_data["access_token"])
-        me = graph.get_object("/me")
+        me = graph_get(access_token_data["access_token"], "/me", LOW_PRIORITY)
         name = me["name"]
         return name
     except facebook.GraphAPIError, e:
@@ -267,11 +930,11 @@ def get_more_feed(object_id, access_token, desired_data, after, until):
     anywhere, so the client must be specific about what data it is requesting.
     """
     try:
-        graph = facebook.GraphAPI(access_token)
+        path = "/" + object_id + "/" + desired_data
         if after:
-            feed = graph.get_object("/" + object_id + "/" + desired_data, after = after)
+            feed = graph_get(access_token, path, after = after)
         else:
-            feed = graph.get_object("/" + object_id + "/" + desired_data, until = until)
+            feed = graph_get(access_token, path, until = until)
         return feed
     except facebook.GraphAPIError, e:
         print e.message
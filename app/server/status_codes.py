@@ -7,6 +7,7 @@ __author__ = "Jeffrey Chan"
 
 STATUS = {
   "OK" : 200,
+  "Not_Modified" : 304,
   "Bad_Request" : 400,
   "Unauthorized" : 401,
   "Forbidden" : 403,
@@ -37,3 +37,34 @@ def instance_parser(instance):
             return False
     except Exception:
         return False
+
+def last_write_signature(instanceID, written_at):
+    """This function returns the signature of the time the user last wrote to
+    the instance.
+    """
+    hmac_hashed = new(wix_secret,
+                      msg=(instanceID + "/" + written_at).encode("utf-8"),
+                      digestmod=sha256).digest()
+    return urlsafe_b64encode(hmac_hashed).replace("=", "")
+
+def sign_last_write(instanceID, written_at):
+    """This function returns the value of the "last_write" header sent back to
+    the client after it writes to the instance. It holds the time of the write
+    (in seconds) and its signature so that the client cannot change it.
+    """
+    written_at = "%.3f" % written_at
+    return written_at + "." + last_write_signature(instanceID, written_at)
+
+def last_write_parser(instanceID, last_write):
+    """This function parses the "last_write" header the client sends back with
+    its reads. It returns the time of the write if the header was signed for
+    the instance, and None otherwise.
+    """
+    try:
+        seconds, millis, signature = last_write.split(".", 2)
+        written_at = seconds + "." + millis
+        if signature == last_write_signature(instanceID, written_at):
+            return float(written_at)
+        return None
+    except Exception:
+        return None
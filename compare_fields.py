@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Running this file compares how many bytes a load of the widget costs with
+and without the field projections used when getting events from Facebook.
+
+With a real (long term) access token of a user with created events, the events
+are retrieved from Facebook with and without the projection:
+
+    python compare_fields.py <access_token> [<event_id> ...]
+
+Without a token, a page of /me/events/created retrieved with the default fields
+can be given instead. The projected page is made from it by keeping only the
+projected fields, the way Facebook would return them:
+
+    python compare_fields.py --sample samples/me_events_created.json [<event_id> ...]
+
+The event IDs are the events saved on the widget. If none are given, the first
+ten events are used. For both the default fields and the projected fields, it
+reports the bytes received from Facebook for the event list (first page), how
+long parsing them takes and the bytes of the JSON the server sends to the
+widget.
+"""
+
+from json import dumps, loads
+from sys import argv, exit
+from time import time
+from urllib import urlencode
+from urllib2 import urlopen
+from app.server.fb import WIDGET_EVENT_FIELDS, clean_data_dict
+
+__author__ = "Jeffrey Chan"
+
+"""How many times a page is parsed to time it."""
+PARSE_RUNS = 100
+
+def fetch(access_token, fields):
+    """Gets the first page of the events created by the user, returning the
+    raw bytes received from Facebook.
+    """
+    args = {"access_token" : access_token}
+    if fields:
+        args["fields"] = fields
+    return urlopen("https://graph.facebook.com/me/events/created?" + \
+                   urlencode(args), timeout=30).read()
+
+def project(raw, fields):
+    """Returns the raw bytes Facebook would have sent for the page if only the
+    given fields had been requested.
+    """
+    page = loads(raw)
+    fields = fields.split(",")
+    page["data"] = [dict((field, event[field]) for field in fields \
+                         if field in event) for event in page["data"]]
+    return dumps(page, separators=(",", ":"))
+
+def parse(raw):
+    """Parses the raw bytes of a page, returning its events and how long
+    parsing took on average.
+    """
+    start = time()
+    for run in range(PARSE_RUNS):
+        data = loads(raw)["data"]
+    return data, (time() - start) / PARSE_RUNS
+
+def widget_bytes(data, event_ids, projected):
+    """Returns the size of the JSON the widget receives for the saved events
+    (processed the same way process_event_data does it). Before the fields
+    were projected, location and venue were blanked instead of removed.
+    """
+    processed = []
+    for event in data:
+        if event["id"] in event_ids:
+            event = clean_data_dict(event)
+            if projected:
+                event.pop("location", None)
+                event.pop("venue", None)
+            else:
+                event["location"] = ""
+                event["venue"] = ""
+            event["eventColor"] = "#000000"
+            processed.append(event)
+    return len(dumps({"settings" : {}, "fb_event_data" : processed,
+                      "active" : "true"}))
+
+if len(argv) < 2 or (argv[1] == "--sample" and len(argv) < 3):
+    print __doc__
+    exit(1)
+
+if argv[1] == "--sample":
+    with open(argv[2]) as sample:
+        sample_raw = sample.read().strip()
+    event_ids = argv[3:]
+else:
+    access_token = argv[1]
+    event_ids = argv[2:]
+rows = []
+for label, fields in (("default fields", None),
+                      ("projected fields", WIDGET_EVENT_FIELDS)):
+    if argv[1] != "--sample":
+        raw = fetch(access_token, fields)
+    elif fields:
+        raw = project(sample_raw, fields)
+    else:
+        raw = sample_raw
+    data, parse_time = parse(raw)
+    if not event_ids:
+        event_ids = [event["id"] for event in data[:10]]
+    rows.append((label, len(raw), parse_time,
+                 widget_bytes(data, event_ids, fields is not None)))
+
+print "%-18s %14s %12s %14s" % ("", "from Facebook", "parse (ms)",
+                                "to widget")
+for label, upstream, parse_time, downstream in rows:
+    print "%-18s %14d %12.3f %14d" % (label, upstream, parse_time * 1000,
+                                       downstream)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+"""Running this file runs a maintenance task over every installation of the
+app (every row of the Users table) and writes one JSON result per row.
+
+    python manage_users.py <task> [options]
+
+Tasks:
+    stats             Reports the number of saved events, whether a Facebook
+                      account is connected, how old its token is and the view.
+    validate-tokens   Asks Facebook whether each saved access token is still
+                      valid and when it expires.
+    normalize-events  Checks that the saved events are a list of
+                      {"eventId", "eventColor"} objects without duplicates and
+                      reports the rows that are not. With --apply, the fixed
+                      events are saved.
+
+The rows are streamed from the database with a server-side cursor in batches of
+--batch-size rows, so memory use does not grow with the size of the table. Each
+batch is processed by a pool of --workers threads (the tasks mostly wait on
+Facebook) and its results are written as newline-delimited JSON before the next
+batch is read.
+
+After every batch, the key of the last row processed is saved to the
+--checkpoint file. Running again with --resume continues after that row and
+appends to the output.
+
+With --apply, the run stops at the first row whose changes could not be saved
+(or that was changed while the run was at it, since saving would overwrite the
+change). The rows before it are saved to the checkpoint, so running again with
+--resume tries that row again.
+
+When the results are written to stdout, anything else the app prints (like
+database errors) goes to stderr so that the output stays valid JSON.
+
+validate-tokens calls Facebook with the app access token, which only counts
+against the call budget of the app (not that of a single user). If that budget
+is used up, the run stops before the batch is saved to the checkpoint, so that
+running again later with --resume checks the rest of the rows.
+"""
+
+from argparse import ArgumentParser
+from json import dumps, loads
+from multiprocessing.pool import ThreadPool
+from os import path, rename
+import sys
+from time import time
+from peewee import MySQLDatabase, PostgresqlDatabase, SqliteDatabase
+from app.server.models import db, replicas, Users, save_events
+from app.server.fb import graph_get, fb_app_access_token, LOW_PRIORITY, \
+                          RateLimitError
+import facebook
+
+__author__ = "Jeffrey Chan"
+
+class SaveError(Exception):
+    """Raised when the changes made by the task to a row could not be
+    saved.
+    """
+    pass
+
+
+COLUMNS = ("instanceID", "compID", "settings", "events", "access_token_data")
+
+def server_side_cursor(database, conn):
+    """Returns a cursor that fetches rows from the database as they are needed
+    rather than all at once.
+    """
+    if isinstance(database, PostgresqlDatabase):
+        return conn.cursor(name="manage_users")
+    elif isinstance(database, MySQLDatabase):
+        from MySQLdb.cursors import SSCursor
+        return conn.cursor(SSCursor)
+    return conn.cursor()
+
+def rows_query(database, after):
+    """Returns the query of the rows of Users after the "after" key (if given),
+    ordered by their primary key.
+    """
+    query = Users.select(*[getattr(Users, column) for column in COLUMNS]) \
+                 .order_by(Users.instanceID, Users.compID)
+    if after:
+        query = query.where((Users.instanceID > after[0]) | \
+                            ((Users.instanceID == after[0]) & \
+                             (Users.compID > after[1])))
+    query.database = database
+    return query
+
+def stream_rows(batch_size, after):
+    """Yields the rows of Users in batches of "batch_size", ordered by their
+    primary key and starting after the "after" key (if given).
+
+    A connection of its own is used so that the rows saved while streaming do
+    not interfere with the cursor. If there are read replicas, the rows are
+    read from the first one to keep the load off the primary database.
+
+    SQLite locks the whole file while a cursor is open, which would keep the
+    changes of the rows from being saved, so there each batch is read with a
+    query of its own instead.
+    """
+    database = replicas[0] if replicas else db
+    if isinstance(database, SqliteDatabase):
+        while True:
+            sql, params = rows_query(database, after).limit(batch_size).sql()
+            conn = database._connect(database.database,
+                                     **database.connect_kwargs)
+            try:
+                rows = conn.execute(sql, params).fetchall()
+            finally:
+                conn.close()
+            if not rows:
+                return
+            batch = [dict(zip(COLUMNS, row)) for row in rows]
+            yield batch
+            after = (batch[-1]["instanceID"], batch[-1]["compID"])
+    sql, params = rows_query(database, after).sql()
+    conn = database._connect(database.database, **database.connect_kwargs)
+    try:
+        cursor = server_side_cursor(database, conn)
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [dict(zip(COLUMNS, row)) for row in rows]
+        cursor.close()
+    finally:
+        conn.close()
+
+def load_json(text):
+    """Parses a JSON column, returning None for empty or broken columns."""
+    try:
+        return loads(text) if text else None
+    except ValueError:
+        return None
+
+def stats(row):
+    """Reports basic stats about the row."""
+    settings = load_json(row["settings"]) or {}
+    events = load_json(row["events"]) or []
+    access_token_data = load_json(row["access_token_data"])
+    result = {"events" : len(events), "active" : bool(access_token_data),
+              "view" : settings.get("view", "") if type(settings) is dict \
+                       else "", "token_age_days" : None}
+    if access_token_data and "generated_time" in access_token_data:
+        age = time() - int(access_token_data["generated_time"])
+        result["token_age_days"] = int(age / (60 * 60 * 24))
+    return result
+
+def validate_tokens(row):
+    """Asks Facebook whether the saved access token is still valid. A
+    RateLimitError is raised if the call could not be made.
+    """
+    access_token_data = load_json(row["access_token_data"])
+    if not access_token_data:
+        return {"active" : False}
+    try:
+        verify = graph_get(fb_app_access_token, "/debug_token", LOW_PRIORITY,
+                           input_token = access_token_data["access_token"])
+        data = verify["data"]
+        return {"active" : True, "is_valid" : data["is_valid"],
+                "expires_at" : data.get("expires_at")}
+    except RateLimitError:
+        raise
+    except facebook.GraphAPIError, e:
+        return {"active" : True, "error" : e.message}
+    except KeyError:
+        return {"active" : True, "error" : "Unexpected reply from Facebook"}
+
+def normalize_events(row):
+    """Checks the format of the saved events, returning the fixed events (as
+    "update") if they need to be changed.
+    """
+    events = load_json(row["events"])
+    if not row["events"]:
+        return {"changed" : False}
+    if type(events) is not list:
+        return {"changed" : True, "update" : "[]", "dropped" : row["events"]}
+    seen = set()
+    fixed = []
+    for event in events:
+        if type(event) is not dict or not event.get("eventId"):
+            continue
+        event_id = str(event["eventId"])
+        if event_id in seen:
+            continue
+        seen.add(event_id)
+        fixed.append({"eventId" : event_id,
+                      "eventColor" : event.get("eventColor", "")})
+    if fixed == events:
+        return {"changed" : False}
+    return {"changed" : True, "update" : dumps(fixed),
+            "dropped" : len(events) - len(fixed)}
+
+TASKS = {"stats" : stats, "validate-tokens" : validate_tokens,
+         "normalize-events" : normalize_events}
+
+def read_checkpoint(checkpoint):
+    """Returns the key of the last row processed (or None) and how many rows
+    had been processed.
+    """
+    if not path.exists(checkpoint):
+        return None, 0
+    with open(checkpoint) as checkpoint_file:
+        data = loads(checkpoint_file.read())
+    return (data["instanceID"], data["compID"]), data["processed"]
+
+def write_checkpoint(checkpoint, row, processed):
+    """Saves the key of the last row processed. The file is replaced in one
+    step so that it is never left half written.
+    """
+    with open(checkpoint + ".tmp", "w") as checkpoint_file:
+        checkpoint_file.write(dumps({"instanceID" : row["instanceID"],
+                                     "compID" : row["compID"],
+                                     "processed" : processed}))
+    rename(checkpoint + ".tmp", checkpoint)
+
+def run(args):
+    """Streams every row through the task, writing the results as they come
+    in. A SaveError is raised (after saving the rows before it to the
+    checkpoint) if the changes of a row could not be saved.
+    """
+    task = TASKS[args.task]
+    after, processed = None, 0
+    if args.resume:
+        after, processed = read_checkpoint(args.checkpoint)
+    if args.output == "-":
+        output = sys.stdout
+        sys.stdout = sys.stderr
+    else:
+        output = open(args.output, "a" if args.resume else "w")
+    pool = ThreadPool(args.workers)
+    last = None
+    try:
+        for batch in stream_rows(args.batch_size, after):
+            for row, result in zip(batch, pool.map(task, batch)):
+                update = result.pop("update", None)
+                if update is not None and args.apply:
+                    if not save_events(row["compID"], row["instanceID"],
+                                       update, row["events"]):
+                        raise SaveError("The events of " + \
+                                        row["instanceID"] + "/" + \
+                                        row["compID"] + " could not be saved")
+                    result["saved"] = True
+                result["instanceID"] = row["instanceID"]
+                result["compID"] = row["compID"]
+                output.write(dumps(result) + "\n")
+                processed += 1
+                last = row
+            output.flush()
+            write_checkpoint(args.checkpoint, batch[-1], processed)
+    except SaveError:
+        output.flush()
+        if last is not None:
+            write_checkpoint(args.checkpoint, last, processed)
+        raise
+    finally:
+        pool.close()
+        if args.output == "-":
+            sys.stdout = output
+        else:
+            output.close()
+
+parser = ArgumentParser(description="Runs a maintenance task over every row "
+                                    "of the Users table.")
+parser.add_argument("task", choices=sorted(TASKS))
+parser.add_argument("--output", default="-",
+                    help="file to write the results to (default: stdout)")
+parser.add_argument("--batch-size", type=int, default=500)
+parser.add_argument("--workers", type=int, default=4)
+parser.add_argument("--checkpoint", default="manage_users.checkpoint")
+parser.add_argument("--resume", action="store_true",
+                    help="continue after the row saved in the checkpoint")
+parser.add_argument("--apply", action="store_true",
+                    help="save the changes made by the task")
+
+if __name__ == "__main__":
+    try:
+        run(parser.parse_args())
+    except (RateLimitError, SaveError), e:
+        sys.stderr.write(e.message + "; run again later with --resume\n")
+        sys.exit(1)
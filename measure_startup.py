@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Running this file measures how long the server takes to start up: how long
+importing the app takes and how long the first requests take once it is
+imported.
+
+    python measure_startup.py [runs] [compID instance]
+
+Each run is done in a new Python process so that every import is cold. The
+first request is made to the widget's HTML file. If a component ID and a
+(signed) Wix instance are given, the first GetSettingsWidget request for that
+widget is measured as well, which includes opening the database connection.
+"""
+
+from json import dumps, loads
+from subprocess import check_output
+from sys import argv, executable
+
+__author__ = "Jeffrey Chan"
+
+"""This code is run in a new process for every run. It prints the timings as
+JSON.
+"""
+RUN = """
+from json import dumps
+from time import time
+start = time()
+from app import flask_app
+imported = time()
+client = flask_app.test_client()
+client.get("/")
+first_file = time()
+timings = {"import" : imported - start, "first_file" : first_file - imported}
+comp_id, instance = %s
+if comp_id:
+    status = client.get("/GetSettingsWidget/" + comp_id,
+                        headers={"X-Wix-Instance" : instance}).status_code
+    timings["first_settings"] = time() - first_file
+    timings["status"] = status
+print dumps(timings)
+"""
+
+runs = int(argv[1]) if len(argv) > 1 else 5
+widget = (argv[2], argv[3]) if len(argv) > 3 else (None, None)
+
+timings = []
+for run in range(runs):
+    output = check_output([executable, "-c", RUN % repr(widget)])
+    timings.append(loads(output.strip().splitlines()[-1]))
+
+for name, label in (("import", "import app"),
+                    ("first_file", "first request (widget HTML)"),
+                    ("first_settings", "first request (GetSettingsWidget)")):
+    values = sorted(timing[name] for timing in timings if name in timing)
+    if values:
+        print "%-36s min %8.1f ms   median %8.1f ms   max %8.1f ms" % \
+              (label, values[0] * 1000, values[len(values) / 2] * 1000,
+               values[-1] * 1000)
+statuses = set(timing["status"] for timing in timings if "status" in timing)
+if statuses:
+    print "GetSettingsWidget status codes: " + dumps(sorted(statuses))
@@ -2,6 +2,8 @@
 """Running this file starts the Flask server"""
 
 from os import walk, path, environ
+from signal import signal, SIGTERM
+from sys import exit
 from app import flask_app
 
 __author__ = "Jeffrey Chan"
@@ -24,6 +26,12 @@ if "HEROKU" not in environ:
                 if path.isfile(filename):
                     extra_files.append(filename)
 
+"""Heroku stops the server with SIGTERM. Exiting normally when it is received
+lets the settings that are still waiting to be saved get written to the
+database before the server stops.
+"""
+signal(SIGTERM, lambda signum, frame: exit(0))
+
 """This starts the Flask server"""
 if "HEROKU" in environ:
     port = int(environ.get('PORT', 5000))
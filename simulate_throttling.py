@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""Running this file simulates Facebook throttling the app and checks that the
+Graph call scheduler (GraphScheduler in app/server/fb.py) reacts to it the way
+it should. No calls are made to Facebook and no time passes for real: the Graph
+API is replaced by a stub and the scheduler runs on a fake clock.
+
+    python simulate_throttling.py
+
+The stub replies to every call with an empty page of events unless it is told
+to throttle, in which case it replies with the rate limit error Facebook would
+send (code 4 for the app, code 17 for a user). Each scenario prints "ok" or
+"FAILED" and the script exits with status 1 if any of them failed.
+"""
+
+from sys import exit
+import facebook
+from app.server import fb
+
+__author__ = "Jeffrey Chan"
+
+class FakeClock(object):
+    """This clock only moves forward when something sleeps on it (or when it
+    is moved by hand), so an hour of throttling is simulated instantly.
+    """
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class GraphStub(object):
+    """This stub stands in for GraphAPI.get_object. It replies with a rate
+    limit error (with the given code) while "throttle" is set.
+    """
+    def __init__(self):
+        self.throttle = None
+
+    def get_object(self, graph, path, **args):
+        if self.throttle is not None:
+            raise facebook.GraphAPIError({"error" : {"message" : "throttled",
+                                                     "code" : self.throttle}})
+        return {"data" : []}
+
+
+def new_scheduler(clock, token_budget=200, app_budget=100000):
+    """Replaces the scheduler used by graph_get with one on the fake clock."""
+    fb.scheduler = fb.GraphScheduler(token_budget=token_budget,
+                                     app_budget=app_budget, clock=clock.time,
+                                     sleep=clock.sleep,
+                                     app_tokens=(fb.fb_app_access_token,))
+    return fb.scheduler
+
+def call(access_token, priority=fb.HIGH_PRIORITY):
+    """Makes a call through graph_get, returning "made", "shed" (not made by
+    the scheduler) or "throttled" (rate limited by the stub).
+    """
+    try:
+        fb.graph_get(access_token, "/me/events/created", priority)
+        return "made"
+    except fb.RateLimitError:
+        return "shed"
+    except facebook.GraphAPIError:
+        return "throttled"
+
+def count(results):
+    """Counts the results of a list of calls."""
+    totals = {}
+    for result in results:
+        totals[result] = totals.get(result, 0) + 1
+    return totals
+
+def waited(access_token):
+    """Makes a high priority call, returning its result and how long it waited
+    on the clock.
+    """
+    start = clock.time()
+    result = call(access_token)
+    return result, clock.time() - start
+
+failures = []
+
+def check(name, actual, expected):
+    """Prints whether the scenario behaved as expected."""
+    if actual == expected:
+        print "ok      " + name
+    else:
+        failures.append(name)
+        print "FAILED  %s: got %r, expected %r" % (name, actual, expected)
+
+stub = GraphStub()
+facebook.GraphAPI.get_object = lambda graph, path, **args: \
+                                   stub.get_object(graph, path, **args)
+
+clock = FakeClock()
+fb.scheduler = fb.GraphScheduler(clock=clock.time, sleep=clock.sleep)
+check("by default a user's calls are not held to a budget",
+      count([call("user") for i in range(1000)]), {"made" : 1000})
+
+new_scheduler(clock)
+results = [call("user") for i in range(250)]
+check("a user's high priority calls stop at the 200 call budget",
+      count(results), {"made" : 200, "shed" : 50})
+
+clock.sleep(3600)
+results = [call("user", fb.LOW_PRIORITY) for i in range(200)]
+check("low priority calls are shed at 80% of the budget",
+      count(results), {"made" : 160, "shed" : 40})
+check("high priority calls can still use the rest of the budget",
+      count([call("user") for i in range(50)]), {"made" : 40, "shed" : 10})
+
+clock.sleep(3600)
+check("the app token is not held to the budget of a single user",
+      count([call(fb.fb_app_access_token) for i in range(300)]),
+      {"made" : 300})
+
+new_scheduler(clock)
+stub.throttle = 17
+results = [call("user")]
+stub.throttle = None
+results.append(call("user", fb.LOW_PRIORITY))
+results.append(call("other user", fb.LOW_PRIORITY))
+check("a user throttled by Facebook is backed off, other users are not",
+      results, ["throttled", "shed", "made"])
+check("high priority calls wait out a short backoff", waited("user"),
+      ("made", 1))
+
+new_scheduler(clock)
+stub.throttle = 17
+results = [waited("user") for i in range(4)]
+check("the backoff doubles with each rate limit in a row", results,
+      [("throttled", 0), ("throttled", 1), ("throttled", 2), ("shed", 0)])
+stub.throttle = None
+clock.sleep(4)
+check("a successful call ends the backoff",
+      (call("user"), fb.scheduler.backoffs), ("made", {}))
+
+new_scheduler(clock)
+stub.throttle = 4
+check("an app rate limit is reported", call("user"), "throttled")
+stub.throttle = None
+check("an app rate limit backs off every user",
+      call("other user", fb.LOW_PRIORITY), "shed")
+clock.sleep(1)
+check("every user is called again once the backoff is over",
+      call("other user", fb.LOW_PRIORITY), "made")
+
+new_scheduler(clock)
+stub.throttle = 17
+call(fb.fb_app_access_token)
+stub.throttle = None
+check("a rate limit on the app token backs off the app",
+      call("user", fb.LOW_PRIORITY), "shed")
+
+if failures:
+    exit(1)